@@ -1,24 +1,33 @@
 """CustomBlocks extension for Python-Markdown."""
 
-import importlib
-import inspect
+import functools
 import re
+import sys
 import warnings
-from typing import List
+import weakref
+from types import MethodType
+from typing import Any, Callable, Dict, List, NamedTuple, Optional, Tuple
 from xml.etree import ElementTree as etree  # noqa: N813, S405
 
 from markdown.blockprocessors import BlockProcessor
 from markdown.core import Markdown
 from markdown.extensions import Extension
-from yamlns import namespace as ns
 
 from .entrypoints import load_entry_points_group
-from .generators import container
 
 generators_group = "markdown.customblocks.generators"
+# Referred by name, so that generators and their dependencies
+# are imported only once a document has custom blocks
+_container_symbol = "customblocks.generators:container"
+# yamlns namespace, imported on the first run() for the same reason
+_ns: Any = None
 
 
-def _installed_generators() -> List:
+# Installed generators by name, loaded on first use
+_installed_generators_cache: Optional[Dict[str, Any]] = None
+
+
+def _installed_generators() -> Dict[str, Any]:
     """
     Retrieves and caches the installed generators.
 
@@ -27,12 +36,186 @@ def _installed_generators() -> List:
     group.
 
     Returns:
-        A list of installed generators.
+        A dict of installed generators by name.
+    """
+    global _installed_generators_cache  # noqa: PLW0603
+    if _installed_generators_cache is None:
+        _installed_generators_cache = load_entry_points_group(generators_group)
+    return _installed_generators_cache
+
+
+@functools.lru_cache(maxsize=None)
+def _resolve_symbol(symbolname: str) -> Callable:
+    """
+    Resolves a 'module:function' symbol name into the generator it names.
+
+    The result is cached since resolution is deterministic for a given name.
+
+    Raises:
+        ValueError: If the symbol is not callable.
+    """
+    import importlib
+
+    modulename, functionname = symbolname.split(":", 1)
+    module = importlib.import_module(modulename)
+    generator = getattr(module, functionname)
+    if not callable(generator):
+        raise ValueError("{} is not callable".format(symbolname))
+    return generator
+
+
+# Parameter kinds in a binding plan
+_CTX, _POSITIONAL_ONLY, _POSITIONAL_OR_KEYWORD, _KEYWORD_ONLY = range(4)
+# Default of the parameters without one
+_MANDATORY = object()
+
+
+class _Plan(NamedTuple):
+    """How headline params are bound to the signature of a generator."""
+
+    flags: Dict[str, int]  # flag or 'no'-flag token -> number of parameters claiming it
+    flagClaims: Tuple[Tuple[str, str, bool], ...]  # (token, parameter name, value), in parameter order
+    slots: Tuple[Tuple[int, str, Any], ...]  # (kind, name, default) of every bindable parameter
+    acceptAnyPos: bool
+    acceptAnyKey: bool
+    passthrough: bool  # just (ctx, *args, **kwds) or (*args, **kwds), params are passed as they come
+    nPos: int  # number of slots bound positionally, ctx included
+    kwOnlyNames: Tuple[str, ...]  # names of the keyword only slots
+
+
+def _build_plan(callback: Callable) -> _Plan:
+    """Computes the binding plan of a callback from its signature."""
+    import inspect
+
+    kinds = {
+        inspect.Parameter.POSITIONAL_ONLY: _POSITIONAL_ONLY,
+        inspect.Parameter.POSITIONAL_OR_KEYWORD: _POSITIONAL_OR_KEYWORD,
+        inspect.Parameter.KEYWORD_ONLY: _KEYWORD_ONLY,
+    }
+    parameters = list(inspect.signature(callback).parameters.values())
+    flagClaims: List[Tuple[str, str, bool]] = []
+    for param in parameters:
+        if type(param.default) is bool or param.annotation is bool:
+            flagClaims.append((param.name, param.name, True))
+            flagClaims.append(("no" + param.name, param.name, False))
+    flags: Dict[str, int] = {}
+    for token, _, _ in flagClaims:
+        flags[token] = flags.get(token, 0) + 1
+    slots: List[Tuple[int, str, Any]] = []
+    for param in parameters:
+        if param.name == "ctx":
+            slots.append((_CTX, param.name, None))
+        elif param.kind in kinds:
+            default = _MANDATORY if param.default is param.empty else param.default
+            slots.append((kinds[param.kind], param.name, default))
+    acceptAnyPos = any(param.kind == param.VAR_POSITIONAL and param.name != "ctx" for param in parameters)
+    acceptAnyKey = any(param.kind == param.VAR_KEYWORD and param.name != "ctx" for param in parameters)
+    return _Plan(
+        flags=flags,
+        flagClaims=tuple(flagClaims),
+        slots=tuple(slots),
+        acceptAnyPos=acceptAnyPos,
+        acceptAnyKey=acceptAnyKey,
+        passthrough=acceptAnyPos and acceptAnyKey and not flags and all(kind == _CTX for kind, _, _ in slots),
+        nPos=sum(kind != _KEYWORD_ONLY for kind, _, _ in slots),
+        kwOnlyNames=tuple(name for kind, name, _ in slots if kind == _KEYWORD_ONLY),
+    )
+
+
+# Binding plans by callback id, for plain callbacks and bound methods.
+# Entries are dropped by a finalizer when the callback dies,
+# so that plans do not keep alive generators built per Markdown instance.
+_plan_cache: Dict[int, _Plan] = {}
+_bound_plan_cache: Dict[int, _Plan] = {}
+
+
+def _compile_plan(callback: Callable) -> _Plan:
     """
-    if not hasattr(_installed_generators, "value"):
-        generators = load_entry_points_group(generators_group)
-        _installed_generators.value = generators
-    return _installed_generators.value
+    Returns the cached binding plan of a callback.
+
+    Bound methods are cached by their underlying function,
+    since a new bound method is created on every attribute access.
+    Callbacks that cannot be weakly referenced are not cached.
+    """
+    if isinstance(callback, MethodType):
+        cache, owner = _bound_plan_cache, callback.__func__
+    else:
+        cache, owner = _plan_cache, callback
+    key = id(owner)
+    plan = cache.get(key)
+    if plan is not None:
+        return plan
+    plan = _build_plan(callback)
+    try:
+        weakref.finalize(owner, cache.pop, key, None)
+    except TypeError:
+        return plan
+    cache[key] = plan
+    return plan
+
+
+# Backslash escapes of Python string literals
+_RE_ESCAPE = re.compile(r"\\(?:x[0-9a-fA-F]{2}|u[0-9a-fA-F]{4}|U[0-9a-fA-F]{8}|N\{[^}]*\}|[0-7]{1,3}|[\s\S])")
+_simple_escapes = {
+    "\\": "\\",
+    "'": "'",
+    '"': '"',
+    "a": "\a",
+    "b": "\b",
+    "f": "\f",
+    "n": "\n",
+    "r": "\r",
+    "t": "\t",
+    "v": "\v",
+    "\n": "",
+}
+
+
+def _unescape(match: re.Match) -> str:
+    """Decodes a single backslash escape, keeping unknown or invalid ones as they are."""
+    escape = match.group()
+    code = escape[1]
+    try:
+        if code in "xuU":
+            return chr(int(escape[2:], 16))
+        if code == "N":
+            import unicodedata
+
+            return unicodedata.lookup(escape[3:-1])
+        if code in "01234567":
+            return chr(int(escape[1:], 8))
+    except (KeyError, ValueError):
+        return escape
+    return _simple_escapes.get(code, escape)
+
+
+def _unquote(token: str) -> str:
+    """
+    Removes the quotes of a quoted param and decodes its backslash escapes.
+
+    Escapes are decoded as a Python string literal would.
+    """
+    content = token[1:-1]
+    if "\\" not in content:
+        return content
+    return _RE_ESCAPE.sub(_unescape, content)
+
+
+class _Ctx:
+    """
+    Context received by generators in the `ctx` parameter.
+
+    A slotted object instead of a namespace, since one is built for every block.
+    """
+
+    __slots__ = ("config", "content", "metadata", "parent", "parser", "type")
+
+    type: str
+    parent: etree.Element
+    content: str
+    parser: Any
+    metadata: dict
+    config: Any
 
 
 class CustomBlocksExtension(Extension):
@@ -41,7 +224,7 @@ class CustomBlocksExtension(Extension):
     def __init__(self, **kwargs):
         self.config = {
             "fallback": [
-                container,
+                _container_symbol,
                 "Renderer used when the type is not defined. By default, is a div container.",
             ],
             "generators": [
@@ -82,48 +265,99 @@ class CustomBlocksProcessor(BlockProcessor):
     - Invoking associated generators for block types to produce output.
 
     Attributes:
+        RE_HEADLINE_PARAMS: Regular expression that matches the headline parameters
+            and ending, right after the block type.
         RE_HEADLINE: Regular expression that detects the block headlines with optional
-            parameters and ending.
+            parameters and ending. Reference for the headline scanner.
+        DEBUG_HEADLINE: When set, the headline scanner checks its results
+            against RE_HEADLINE.
         RE_PARAM: Regular expression that extracts key-value or keyless parameters
             from parsed headlines.
         RE_END: Regular expression that identifies optional end markers in blocks.
     """
 
-    # Detects headlines
-    RE_HEADLINE = re.compile(
-        r"(?:^|\n)::: *"  # marker
-        r"([\w\-]+)"  # keyword
-        r"(?:( |\\\n)+(?:[\w]+=)?("  # params (optional keyword)
-        r"'(?:\\.|[^'])*'|"  # single quoted
-        r'"(?:\\.|[^"])*"|'  # double quoted
+    # Matches the headline params and ending, starting just after the keyword.
+    # Each param is matched inside a lookahead and then consumed
+    # by a backreference, which emulates an atomic group with plain re:
+    # a matched param is never retried in a different way, so headlines
+    # with a bad ending fail in linear time instead of exponential.
+    _PARAMS_PATTERN = (
+        r"(?:(?=(?P<param>(?: |\\\n)+(?:[\w]+=)?(?:"  # params (optional keyword)
+        r"'(?:[^'\\]|\\[\s\S])*'(?=\s|\\\n|$)|"  # single quoted
+        r'"(?:[^"\\]|\\[\s\S])*"(?=\s|\\\n|$)|'  # double quoted
         r"[\S]+"  # single word
-        r"))*"
+        r")))(?P=param))*"
         r"\s*(?:\n|$)"  # ending
     )
+    RE_HEADLINE_PARAMS = re.compile(_PARAMS_PATTERN)
+    # Detects headlines. Reference grammar for `_scanHeadline`,
+    # which only uses it to check itself when DEBUG_HEADLINE is set.
+    RE_HEADLINE = re.compile(r"(?:^|\n)::: *([\w\-]+)" + _PARAMS_PATTERN)  # marker, keyword, params and ending
+    DEBUG_HEADLINE = False
+    # Last scanned (block, headline), so that run() reuses the scan done in test()
+    _lastScan: Tuple[Optional[str], Optional[Tuple[int, str, str, int]]] = (None, None)
     # Extracts every parameter from the headline as (optional) key and value
     RE_PARAM = re.compile(
         r" (?:([\w\-]+)=)?("
-        r"'(?:\\.|[^'])*'|"  # single quoted
-        r'"(?:\\.|[^"])*"|'  # double quoted
+        r"'(?:[^'\\]|\\[\s\S])*'|"  # single quoted
+        r'"(?:[^"\\]|\\[\s\S])*"|'  # double quoted
         r"[\S]+"  # single word
         r")"
     )
-    # Detect optional end markers
+    # Detect optional end markers. Kept as reference, run() strips them by prefix.
     RE_END = re.compile(r"^:::(?:$|\n)")
 
-    def test(self, parent: etree.Element, block: str) -> re.Match[str] | None:
+    def test(self, parent: etree.Element, block: str) -> Optional[Tuple[int, str, str, int]]:
         """Checks whether a block matches the expected headline format."""
-        return self.RE_HEADLINE.search(block)
+        # Most blocks have no marker at all, reject them right away
+        if not block.startswith(":::") and "\n:::" not in block:
+            return None
+        headline = self._scanHeadline(block)
+        self._lastScan = block, headline
+        return headline
+
+    def _scanHeadline(self, block: str) -> Optional[Tuple[int, str, str, int]]:
+        """
+        Locates the first headline in the block.
+
+        Markers and keywords are scanned by hand so that regular
+        blocks are rejected without running any regex,
+        and only the params of actual candidates are matched,
+        anchored right after the keyword.
+
+        Returns:
+            A (start, type, params, end) tuple, or None if no headline is found.
+        """
+        result = None
+        size = len(block)
+        start = 0 if block.startswith(":::") else block.find("\n:::")
+        while start != -1:
+            i = start + 3 if start == 0 and block[0] == ":" else start + 4
+            while i < size and block[i] == " ":
+                i += 1
+            typeStart = i
+            while i < size and (block[i].isalnum() or block[i] in "_-"):
+                i += 1
+            match = i != typeStart and self.RE_HEADLINE_PARAMS.match(block, i)
+            if match:
+                result = start, block[typeStart:i], block[i : match.end()], match.end()
+                break
+            start = block.find("\n:::", start + 1)
+
+        if self.DEBUG_HEADLINE:
+            match = self.RE_HEADLINE.search(block)
+            expected = match and (match.start(), match.group(1), block[match.end(1) : match.end()], match.end())
+            assert result == (expected or None), f"Headline scan mismatch: {result!r} != {expected!r}"
+        return result
+
+    @functools.cached_property
+    def generatorMap(self) -> Dict[str, Any]:
+        """Installed generators updated with the configured ones, computed on first use."""
+        # A copy, so that neither the shared installed generators nor the config are aliased
+        return {**_installed_generators(), **self.config["generators"]}
 
     def _getGenerator(self, symbolname):
-        if callable(symbolname):
-            return symbolname
-        modulename, functionname = symbolname.split(":", 1)
-        module = importlib.import_module(modulename)
-        generator = getattr(module, functionname)
-        if not callable(generator):
-            raise ValueError("{} is not callable".format(symbolname))
-        return generator
+        return symbolname if callable(symbolname) else _resolve_symbol(symbolname)
 
     def _indentedContent(self, blocks):
         """
@@ -132,14 +366,20 @@ class CustomBlocksProcessor(BlockProcessor):
         Returns the indented lines removing the indentations.
         """
         content = []
-        while blocks:
-            block = blocks.pop(0)
+        consumed = 0
+        unindented = ""
+        for block in blocks:
+            consumed += 1
             indented, unindented = self.detab(block)
             if indented:
                 content.append(indented)
             if unindented:
-                blocks.insert(0, unindented)
                 break
+        # Drop consumed blocks at once, instead of shifting the list on each one
+        if unindented:
+            blocks[:consumed] = [unindented]
+        else:
+            del blocks[:consumed]
         return "\n\n".join(content)
 
     def _processParams(self, params):
@@ -151,14 +391,17 @@ class CustomBlocksProcessor(BlockProcessor):
         The method returns a tuple of a list with all keyless
         parameters and a dict with all keyword parameters.
         """
-        params = params.replace("\\\n", " ")
+        if "\\\n" in params:
+            params = params.replace("\\\n", " ")
+        # Every param is preceded by a space
+        if " " not in params:
+            return [], {}
         args = []
         kwd = {}
         for key, param in self.RE_PARAM.findall(params):
-            if param[0] == param[-1] == '"':
-                param = eval(param)
-            if param[0] == param[-1] == "'":
-                param = eval(param)
+            first = param[0]
+            if first == param[-1] and first in "\"'" and len(param) > 1:
+                param = _unquote(param)
             if key:
                 kwd[key] = param
             else:
@@ -174,58 +417,66 @@ class CustomBlocksProcessor(BlockProcessor):
         def warn(message):
             warnings.warn(f"In block '{ctx.type}', " + message)
 
-        signature = inspect.signature(callback)
-
-        # Turn flags into boolean keywords
-        for name, param in signature.parameters.items():
-            if type(param.default) is not bool and param.annotation is not bool:
-                continue
+        plan = _compile_plan(callback)
+        if plan.passthrough:
+            return ([ctx, *args] if plan.slots else args), kwds
 
-            if name in args:
-                args.remove(name)
-                kwds[name] = True
-
-            if "no" + name in args:
-                args.remove("no" + name)
-                kwds[name] = False
-
-        outargs = []
-        outkwds = {}
-        acceptAnyKey = False
-        acceptAnyPos = False
-        for name, param in signature.parameters.items():
-            if name == "ctx":
-                outargs.append(ctx)
-                continue
-            if param.kind == param.VAR_KEYWORD:
-                acceptAnyKey = True
-                continue
-            if param.kind == param.VAR_POSITIONAL:
-                acceptAnyPos = True
+        # Turn flags into boolean keywords.
+        # Each parameter claiming a token takes one occurrence, in parameter order,
+        # so 'noflag' may be taken both by 'flag' and by a parameter named 'noflag'.
+        if plan.flags:
+            taken: Dict[str, int] = {}
+            remaining = []
+            for arg in args:
+                count = taken.get(arg, 0)
+                if count < plan.flags.get(arg, 0):
+                    taken[arg] = count + 1
+                else:
+                    remaining.append(arg)
+            args = remaining
+            for token, name, flag in plan.flagClaims:
+                count = taken.get(token, 0)
+                if count:
+                    taken[token] = count - 1
+                    kwds[name] = flag
+
+        # Sized upfront from the plan, and filled in slot order
+        outargs = [None] * plan.nPos
+        outkwds = dict.fromkeys(plan.kwOnlyNames)
+        npos = 0
+        nargs = len(args)
+        nextarg = 0
+        for kind, name, default in plan.slots:
+            if kind == _CTX:
+                outargs[npos] = ctx
+                npos += 1
                 continue
 
-            value = (
-                kwds.pop(name)
-                if name in kwds and param.kind != param.POSITIONAL_ONLY
-                else args.pop(0)
-                if args and param.kind != param.KEYWORD_ONLY
-                else param.default
-                if param.default is not param.empty
-                else warn(f"missing mandatory attribute '{name}'") or ""
-            )
-            if param.kind == param.KEYWORD_ONLY:
+            if name in kwds and kind != _POSITIONAL_ONLY:
+                value = kwds.pop(name)
+            elif nextarg < nargs and kind != _KEYWORD_ONLY:
+                value = args[nextarg]
+                nextarg += 1
+            elif default is not _MANDATORY:
+                value = default
+            else:
+                warn(f"missing mandatory attribute '{name}'")
+                value = ""
+            if kind == _KEYWORD_ONLY:
                 outkwds[name] = value
             else:
-                outargs.append(value)
+                outargs[npos] = value
+                npos += 1
 
         # Extend var pos
-        if acceptAnyPos:
-            outargs.extend(args)
+        extras = args[nextarg:]
+        if plan.acceptAnyPos:
+            outargs.extend(extras)
         else:
-            for arg in args:
+            for arg in extras:
                 warn(f"ignored extra attribute '{arg}'")
         # Extend var key
-        if acceptAnyKey:
+        if plan.acceptAnyKey:
             outkwds.update(kwds)
         else:
             for key in kwds:
@@ -234,15 +485,24 @@ class CustomBlocksProcessor(BlockProcessor):
         return outargs, outkwds
 
     def _extractHeadline(self, block):
-        match = self.RE_HEADLINE.search(block)
+        lastBlock, headline = self._lastScan
+        if lastBlock is not block:
+            headline = self._scanHeadline(block)
+        start, blocktype, params, end = headline
         return (
-            block[: match.start()],  # pre
-            match.group(1),  # type
-            block[match.end(1) : match.end()],  # params
-            block[match.end() :],  # post
+            block[:start],  # pre
+            sys.intern(blocktype),  # type, interned since the same few types recur
+            params,  # params
+            block[end:],  # post
         )
 
     def run(self, parent, blocks):
+        global _ns  # noqa: PLW0603
+        if _ns is None:
+            from yamlns import namespace
+
+            _ns = namespace
+
         block = blocks[0]
         pre, blocktype, params, post = self._extractHeadline(blocks[0])
         if pre:
@@ -250,22 +510,28 @@ class CustomBlocksProcessor(BlockProcessor):
         blocks[0] = post
         args, kwds = self._processParams(params)
         content = self._indentedContent(blocks)
-        # Remove optional closing if present
+        # Remove optional closing if present, as RE_END would, without a regex
         if blocks:
-            blocks[0] = self.RE_END.sub("", blocks[0])
+            following = blocks[0]
+            if following in (":::", ":::\n"):
+                blocks[0] = following[3:]
+            elif following.startswith(":::\n"):
+                blocks[0] = following[4:]
 
-        generators = dict(_installed_generators(), **self.config["generators"])
-        generator = self._getGenerator(generators.get(blocktype, container))
+        generator = self._getGenerator(self.generatorMap.get(blocktype, _container_symbol))
 
-        ctx = ns()
+        ctx = _Ctx()
         ctx.type = blocktype
         ctx.parent = parent
         ctx.content = content
         ctx.parser = self.parser
-        if not hasattr(self.parser.md, "Meta") or not self.parser.md.Meta:
-            self.parser.md.Meta = {}
-        ctx.metadata = self.parser.md.Meta
-        ctx.config = ns(self.config.get("config", {}))
+        # Metadata extensions may set Meta on every conversion, even to None,
+        # so it cannot be initialized just once when extending Markdown
+        metadata = getattr(self.parser.md, "Meta", None)
+        if not metadata:
+            metadata = self.parser.md.Meta = {}
+        ctx.metadata = metadata
+        ctx.config = _ns(self.config.get("config", {}))
 
         outargs, kwds = self._adaptParams(generator, ctx, args, kwds)
 
@@ -273,9 +539,8 @@ class CustomBlocksProcessor(BlockProcessor):
 
         if result is None:
             return True
-        if type(result) is str:
-            result = result.encode("utf8")
-        if type(result) is bytes:
+        # Parsed straight from str, without encoding it first
+        if isinstance(result, (str, bytes, bytearray)):
             result = etree.XML(result)
         parent.append(result)
         return True
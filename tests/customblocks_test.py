@@ -1,8 +1,13 @@
+import gc
+import sys
 import unittest
+import weakref
 from xml.etree import ElementTree as etree  # noqa: N813
 
 from markdown import test_tools  # type: ignore[import-untyped]
 
+from customblocks.customblocks import CustomBlocksProcessor, _compile_plan, _plan_cache
+
 try:
     import full_yaml_metadata
 except ImportError:
@@ -350,6 +355,26 @@ class CustomBlockExtension_Test(test_tools.TestCase):
             """,
         )
 
+    def test_quotedValues_nonAscii(self):
+        self.assertMarkdown(
+            """\
+            ::: myblock key="càfè 日本\\t\\u00f1"
+            """,
+            """\
+            <div class="myblock" key="càfè 日本\tñ"></div>
+            """,
+        )
+
+    def test_quotedValues_escapedNonAscii(self):
+        self.assertMarkdown(
+            """\
+            ::: myblock key="\\日 \\\\本 \\N{LATIN SMALL LETTER N WITH TILDE} \\101 \\x41"
+            """,
+            """\
+            <div class="myblock" key="\\日 \\本 ñ A A"></div>
+            """,
+        )
+
     def test_spacesAtTheEnd(self):
         self.assertMarkdown(
             """\
@@ -415,6 +440,18 @@ class CustomBlockExtension_Test(test_tools.TestCase):
             """,
         )
 
+    def test_headline_manyKeyParams_badEnding_failsFast(self):
+        # Used to take exponential time on the number of key params
+        params = " ".join(["key=value"] * 40)
+        self.assertMarkdown(
+            f"""\
+            ::: myblock {params}\u00a0bad
+            """,
+            f"""\
+            <p>::: myblock {params}\u00a0bad</p>
+            """,
+        )
+
     def test_customGenerator_returnsEtree(self):
         def custom():
             return etree.Element("custom")
@@ -460,6 +497,21 @@ class CustomBlockExtension_Test(test_tools.TestCase):
             """,
         )
 
+    def test_customGenerator_returnsString_nonAscii(self):
+        def custom():
+            return "<custom>càfè 日本</custom>"
+
+        self.setupCustomBlocks(custom=custom)
+
+        self.assertMarkdown(
+            """\
+            ::: custom
+            """,
+            """\
+            <custom>càfè 日本</custom>
+            """,
+        )
+
     def test_customGenerator_receivesParent(self):
         def custom(ctx):
             etree.SubElement(ctx.parent, "custom")
@@ -790,6 +842,48 @@ class CustomBlockExtension_Test(test_tools.TestCase):
             """,
         )
 
+    def test_customGenerator_flag_repeatedTakenOnce(self):
+        def custom(flag=False, *args):
+            return "<custom flag='{}' args='{}'></custom>".format(flag, " ".join(args))
+
+        self.setupCustomBlocks(custom=custom)
+        self.assertMarkdown(
+            """\
+            ::: custom flag other flag
+            """,
+            """\
+            <custom args="other flag" flag="True"></custom>
+            """,
+        )
+
+    def test_customGenerator_flag_andNoflag_noflagWins(self):
+        def custom(flag=False):
+            return "<custom flag='{}'></custom>".format(flag)
+
+        self.setupCustomBlocks(custom=custom)
+        self.assertMarkdown(
+            """\
+            ::: custom noflag flag
+            """,
+            """\
+            <custom flag="False"></custom>
+            """,
+        )
+
+    def test_customGenerator_flag_namedLikeNoflag_bothTaken(self):
+        def custom(flag=False, noflag=False, *args):
+            return "<custom flag='{}' noflag='{}' args='{}'></custom>".format(flag, noflag, " ".join(args))
+
+        self.setupCustomBlocks(custom=custom)
+        self.assertMarkdown(
+            """\
+            ::: custom noflag noflag
+            """,
+            """\
+            <custom args="" flag="False" noflag="True"></custom>
+            """,
+        )
+
     def test_customGenerator_unparsedContentReceived(self):
         def custom(ctx):
             return "<custom>{}</custom>".format(ctx.content)
@@ -862,6 +956,74 @@ class CustomBlockExtension_Test(test_tools.TestCase):
             """,
         )
 
+    def test_customGenerator_ctxKeptAfterNestedBlocks(self):
+        def custom(ctx):
+            element = etree.Element("custom")
+            ctx.parser.parseChunk(element, ctx.content)
+            element.text = ctx.type
+            return element
+
+        def inner(ctx):
+            return f"<inner>{ctx.type}</inner>"
+
+        self.setupCustomBlocks(custom=custom, inner=inner)
+        self.assertMarkdown(
+            """\
+            ::: custom
+                ::: inner
+            """,
+            """\
+            <custom>custom<inner>inner</inner></custom>
+            """,
+        )
+
+    def test_customGenerator_boundMethod(self):
+        class Custom:
+            prefix = "bound"
+
+            def render(self, ctx, positional, flag=False):
+                return f"<custom>{self.prefix} {positional} {flag}</custom>"
+
+        self.setupCustomBlocks(custom=Custom().render)
+        self.assertMarkdown(
+            """\
+            ::: custom value flag
+            """,
+            """\
+            <custom>bound value True</custom>
+            """,
+        )
+
+    def test_customGenerator_boundMethod_varArgs(self):
+        class Custom:
+            def render(*args, **kwds):
+                return f"<custom>{args[1:]} {kwds}</custom>"
+
+        self.setupCustomBlocks(custom=Custom().render)
+        self.assertMarkdown(
+            """\
+            ::: custom p1 p2 k=3
+            """,
+            """\
+            <custom>('p1', 'p2') {'k': '3'}</custom>
+            """,
+        )
+
+    @unittest.skipIf(sys.version_info < (3, 10), "staticmethod objects are callable since Python 3.10")
+    def test_customGenerator_staticMethod(self):
+        def render(ctx, positional):
+            return f"<custom>{ctx.type} {positional}</custom>"
+
+        self.setupCustomBlocks(custom=staticmethod(render))
+        self.assertMarkdown(
+            """\
+            ::: custom value
+            """,
+            """\
+            <custom>custom value</custom>
+            """,
+        )
+
     def test_metadata_withNoMetadataExtension(self):
         def custom(ctx):
             return "<custom>{}</custom>".format(ctx.metadata)
@@ -1050,6 +1212,96 @@ class CustomBlockExtension_Test(test_tools.TestCase):
         self.assertEqual(format(ctx.exception), "tests.customblocks_test:notcallable is not callable")
 
 
+class HeadlineScanner_Test(unittest.TestCase):
+    class Processor(CustomBlocksProcessor):
+        DEBUG_HEADLINE = True
+
+        def __init__(self):
+            pass
+
+    def assertScan(self, block, expected):
+        self.assertEqual(self.Processor()._scanHeadline(block), expected)
+
+    def test_noMarker(self):
+        self.assertScan("Just a paragraph", None)
+
+    def test_markerWithoutType(self):
+        self.assertScan("::: \n", None)
+
+    def test_simple(self):
+        self.assertScan("::: myblock\n", (0, "myblock", "\n", 12))
+
+    def test_inMiddleOfABlock(self):
+        self.assertScan("Para\n:::myblock param\nmore", (4, "myblock", " param\n", 22))
+
+    def test_secondMarkerMatches(self):
+        self.assertScan("Para\n:::.bad\n::: good", (12, "good", "", 21))
+
+    def test_quotedParams(self):
+        self.assertScan(
+            """::: myblock key="a \\" b" 'c d'\n""",
+            (0, "myblock", """ key="a \\" b" 'c d'\n""", 31),
+        )
+
+    def test_quotedParam_stickedToText_takenAsWord(self):
+        self.assertScan('::: myblock "a b"c', (0, "myblock", ' "a b"c', 18))
+
+    def test_headlineSplit(self):
+        self.assertScan("::: myblock a \\\nb\ncontent", (0, "myblock", " a \\\nb\n", 18))
+
+    def test_headlineSplit_atTheEnd(self):
+        self.assertScan("::: myblock a \\\n", (0, "myblock", " a \\\n", 16))
+
+    def test_badEnding(self):
+        self.assertScan("::: myblock a\u00a0b", None)
+
+
+class PlanCache_Test(unittest.TestCase):
+    def test_cached(self):
+        def custom(ctx, param):
+            pass
+
+        self.assertIs(_compile_plan(custom), _compile_plan(custom))
+
+    def test_boundMethods_cachedByFunction(self):
+        class Custom:
+            def render(self, ctx, param):
+                pass
+
+        self.assertIs(_compile_plan(Custom().render), _compile_plan(Custom().render))
+
+    def test_generatorsNotKeptAlive(self):
+        def custom(ctx, param):
+            pass
+
+        _compile_plan(custom)
+        ref = weakref.ref(custom)
+        del custom
+        gc.collect()
+        self.assertIsNone(ref())
+
+    def test_evictedWithGenerator(self):
+        def custom(ctx, param):
+            pass
+
+        _compile_plan(custom)
+        key = id(custom)
+        self.assertIn(key, _plan_cache)
+        del custom
+        gc.collect()
+        self.assertNotIn(key, _plan_cache)
+
+    def test_notWeakReferenceable_notCached(self):
+        class Custom:
+            __slots__ = ()
+
+            def __call__(self, ctx, param):
+                pass
+
+        plan = _compile_plan(Custom())
+        self.assertEqual([name for _, name, _ in plan.slots], ["ctx", "param"])
+
+
 def mycustom():
     return "<custom></custom>"
 